@@ -1,29 +1,89 @@
+import argparse
 import os
-import subprocess, shutil
-
-def add_to_7z(local_folder, smb_folder):
-    # 將本地文件複製到 SMB 共享文件夾
-    for root, dirs, files in os.walk(local_folder):
-        for file in files:
-            local_file = os.path.join(root, file)
-            smb_file = os.path.join(smb_folder, file)
-            # 使用 shutil 將文件複製到 SMB 共享文件夾
-            shutil.copy2(local_file, smb_file)
-    
-    # 定義壓縮檔案路徑
-    archive_path = os.path.join(smb_folder, '和同事壞壞.7z')
-    
-    # 使用 7z 命令進行壓縮
-    compress_cmd = f"7z a {archive_path} {smb_folder}/*"
-    subprocess.run(compress_cmd, shell=True)
-    
+import shutil
+import subprocess
+import tempfile
+
+from compression_profile import ProfileSummary, choose_method, list_files, profile_command, split_files
+
+ARCHIVE_NAME = '和同事壞壞.7z'
+MODES = ("stage", "direct", "copy")
+
+def run_7z(archive_path, local_folder, names, summary=None):
+    # 參數用 list 傳，路徑有空白也沒問題；在 local_folder 底下執行，壓縮檔裡保留相對路徑
+    if summary is None:
+        subprocess.run(['7z', 'a', archive_path, '--', *names], cwd=local_folder, check=True)
+        return
+    # 大多是媒體檔就只打包、否則用 LZMA2，執行一次 7z 加進壓縮檔
+    store, compress, store_bytes, compress_bytes = split_files(local_folder, list(list_files(local_folder, names)))
+    method = choose_method(store_bytes, compress_bytes)
+    summary.add(os.path.basename(os.path.normpath(local_folder)), method, store, compress, store_bytes, compress_bytes)
+    with tempfile.TemporaryDirectory() as list_dir:
+        subprocess.run(profile_command('a', archive_path, method, store + compress, list_dir), cwd=local_folder, check=True)
+
+def add_to_7z(local_folder, smb_folder, mode="stage", profile="auto", replace=False):
+    """把 local_folder 加進 smb_folder 裡的壓縮檔
+
+    stage：在本機暫存資料夾壓好，只把完成的壓縮檔複製到 SMB。SMB 上已經有壓縮檔時會先複製回本機再加入，
+    保留之前壓縮的內容；replace 為 True 時不讀舊的壓縮檔，只用本機資料夾的內容重新建立
+    direct：7z 直接讀本機檔案、寫到 SMB 上的壓縮檔
+    copy：舊做法，先把檔案逐一複製到 SMB 再壓縮，每個位元組都會經過網路兩次
+    profile 是 auto 時依檔案內容選擇壓縮方式，default 用 7z 預設值
+    """
+    # 7z 在 local_folder 或 smb_folder 底下執行，壓縮檔路徑要用絕對路徑
+    local_folder = os.path.abspath(local_folder)
+    smb_folder = os.path.abspath(smb_folder)
+    summary = ProfileSummary() if profile == "auto" else None
+    archive_path = os.path.join(smb_folder, ARCHIVE_NAME)
+
+    if mode == "copy":
+        # 將本地文件複製到 SMB 共享文件夾
+        for root, dirs, files in os.walk(local_folder):
+            for file in files:
+                shutil.copy2(os.path.join(root, file), os.path.join(smb_folder, file))
+        # 相當於原本的 smb_folder/*，但略過壓縮檔本身
+        names = [name for name in os.listdir(smb_folder) if not name.startswith('.') and name != ARCHIVE_NAME]
+        run_7z(archive_path, smb_folder, names, summary)
+    else:
+        names = [name for name in os.listdir(local_folder) if not name.startswith('.')]
+        if mode == "direct":
+            run_7z(archive_path, local_folder, names, summary)
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                local_archive = os.path.join(tmp_dir, ARCHIVE_NAME)
+                if os.path.exists(archive_path) and not replace:
+                    shutil.copyfile(archive_path, local_archive)
+                run_7z(local_archive, local_folder, names, summary)
+                # 先複製成暫存名稱再改名，複製到一半中斷不會弄壞 SMB 上原本的壓縮檔
+                partial = archive_path + '.part'
+                shutil.copyfile(local_archive, partial)
+                os.replace(partial, archive_path)
+
+    if summary:
+        summary.report()
     print(f"Files from {local_folder} have been added to {archive_path}")
 
 def main():
-    local_folder = "/Users/leo/gallery-dl/"
-    smb_folder = "/Volumes/photo/"
-    
-    add_to_7z(local_folder, smb_folder)
+    parser = argparse.ArgumentParser(description=f"Compress a local folder into {ARCHIVE_NAME} on the SMB share")
+    parser.add_argument("local_folder", nargs="?", default="/Users/leo/gallery-dl/", help="Local folder to compress")
+    parser.add_argument("smb_folder", nargs="?", default="/Volumes/photo/", help="Mounted SMB share for the archive")
+    parser.add_argument(
+        "-m", "--mode", choices=MODES, default="stage",
+        help="stage: build the archive locally (starting from a copy of the existing one) and copy only the finished file, "
+             "direct: write the archive straight to the share, "
+             "copy: copy every file to the share first, then compress there (old behaviour)",
+    )
+    parser.add_argument(
+        "-p", "--profile", choices=("auto", "default"), default="auto",
+        help="auto: store folders that are mostly already-compressed media with -mx0 and compress the others with LZMA2, "
+              "default: 7z's own settings")
+    parser.add_argument(
+        "--replace", action="store_true",
+        help="With --mode stage, build a new archive from the local folder only and replace the existing one "
+             "instead of adding to it; files archived earlier that are no longer local are dropped")
+    args = parser.parse_args()
+
+    add_to_7z(args.local_folder, args.smb_folder, args.mode, args.profile, args.replace)
 
 if __name__ == "__main__":
     main()
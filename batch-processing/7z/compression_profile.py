@@ -0,0 +1,112 @@
+"""依照檔頭和 entropy 判斷檔案還能不能壓縮，讓 7z 對大多是媒體檔的資料夾只打包（-mx0）、其他的用 LZMA2"""
+import math
+import os
+import threading
+from collections import Counter
+
+SAMPLE_SIZE = 4096
+# bits/byte，已經壓縮過的資料接近 8，文字大約 4 到 5
+ENTROPY_THRESHOLD = 7.5
+# 不能壓縮的資料佔這個比例以上，整個資料夾只打包
+STORE_RATIO = 0.8
+STORE_SWITCHES = ["-mx0"]
+COMPRESS_SWITCHES = ["-m0=LZMA2", "-mx7"]
+
+# 已經壓縮過的格式：(偏移, 檔頭)
+MAGIC = [
+    (0, b"\xff\xd8\xff"),              # JPEG
+    (0, b"\x89PNG"),
+    (0, b"GIF8"),
+    (8, b"WEBP"),                      # RIFF....WEBP
+    (4, b"ftyp"),                      # MP4 / MOV / HEIC / AVIF
+    (0, b"\x1a\x45\xdf\xa3"),          # MKV / WebM
+    (0, b"ID3"),                       # MP3
+    (0, b"PK\x03\x04"),                # ZIP
+    (0, b"7z\xbc\xaf\x27\x1c"),
+    (0, b"\x1f\x8b"),                  # gzip
+]
+
+def entropy(data):
+    total = len(data)
+    return -sum(n / total * math.log2(n / total) for n in Counter(data).values())
+
+def is_incompressible(path):
+    # 只讀檔頭，認得的媒體格式直接判定，其他的看取樣的 entropy
+    with open(path, "rb") as f:
+        head = f.read(SAMPLE_SIZE)
+    for offset, magic in MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return True
+    # 太小的檔案 entropy 不準，交給 LZMA2 也花不了多少時間
+    return len(head) >= 256 and entropy(head) >= ENTROPY_THRESHOLD
+
+def split_files(cwd, names):
+    """把相對於 cwd 的檔案分成 (只打包, 要壓縮, 只打包的大小, 要壓縮的大小)"""
+    store, compress = [], []
+    store_bytes = compress_bytes = 0
+    for name in names:
+        path = os.path.join(cwd, name)
+        size = os.path.getsize(path)
+        if is_incompressible(path):
+            store.append(name)
+            store_bytes += size
+        else:
+            compress.append(name)
+            compress_bytes += size
+    return store, compress, store_bytes, compress_bytes
+
+def list_files(cwd, names):
+    # 把資料夾展開成檔案，路徑維持相對於 cwd，壓縮檔裡的結構跟直接給資料夾時一樣
+    for name in names:
+        path = os.path.join(cwd, name)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    yield os.path.relpath(os.path.join(root, file), cwd)
+        else:
+            yield name
+
+def choose_method(store_bytes, compress_bytes):
+    """回傳 store 或 lzma2，大部分資料已經壓縮過時只打包"""
+    total = store_bytes + compress_bytes
+    return "store" if total and store_bytes >= total * STORE_RATIO else "lzma2"
+
+def profile_command(action, archive_path, method, names, list_dir, extra=()):
+    """回傳一個 7z 指令，所有檔案寫在同一個 listfile 裡，用 method 的方式壓縮
+
+    7z 每次執行都會把整個壓縮檔重寫一次，對已經存在的壓縮檔（7z u、加進舊的壓縮檔）
+    分兩次加入的話舊內容要讀寫兩遍，所以每個資料夾只選一種方式、只執行一次。
+    只打包時少量文字沒有壓縮，LZMA2 時媒體檔多花一些時間，兩種損失都比重寫整個壓縮檔小。
+    """
+    switches = STORE_SWITCHES if method == "store" else COMPRESS_SWITCHES
+    listfile = os.path.join(list_dir, "files.txt")
+    with open(listfile, "w", encoding="utf-8") as f:
+        f.write("\n".join(names) + "\n")
+    return ["7z", action, *extra, *switches, "-scsUTF-8", archive_path, f"@{listfile}"]
+
+class ProfileSummary:
+    """記錄每個資料夾的決定，最後印出有多少資料省掉了 LZMA2"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store_folders = self.compress_folders = 0
+        self.store_bytes = self.compress_bytes = 0
+
+    def add(self, folder, method, store, compress, store_bytes, compress_bytes):
+        size = store_bytes + compress_bytes
+        with self.lock:
+            if method == "store":
+                self.store_folders += 1
+                self.store_bytes += size
+            else:
+                self.compress_folders += 1
+                self.compress_bytes += size
+            print(f"Profile {folder}: {method} ({len(store)} media files {store_bytes / 1e6:.1f} MB, "
+                  f"{len(compress)} other files {compress_bytes / 1e6:.1f} MB)")
+
+    def report(self):
+        total = self.store_bytes + self.compress_bytes
+        if not total:
+            return
+        print(f"Stored {self.store_folders} folders ({self.store_bytes / 1e6:.1f} MB) without compression, "
+              f"compressed {self.compress_folders} folders ({self.compress_bytes / 1e6:.1f} MB) with LZMA2; "
+              f"LZMA2 skipped on {self.store_bytes / total:.0%} of the data")
@@ -1,23 +1,172 @@
+import argparse
+import json
 import os
 import subprocess
-import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def compress_folder(folder_path):
-    parent_folder = os.path.dirname(folder_path)
-    folder_name = os.path.basename(folder_path)
-    output_path = os.path.join(parent_folder, f"{folder_name}.7z")
+from compression_profile import ProfileSummary, choose_method, profile_command, split_files
 
-    # 使用 7z 命令進行壓縮
-    subprocess.run(['7z', 'a', output_path, folder_path])
-    print(f"Compressed {folder_path} to {output_path}")
+MANIFEST_NAME = ".zip_7z-manifest.json"
 
-def main(parent_folder):
+def scan_folder(folder_path):
+    """用 scandir 遞迴走訪一次，回傳 {相對路徑: [大小, mtime_ns]}"""
+    files = {}
+
+    def walk(directory):
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    walk(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    files[os.path.relpath(entry.path, folder_path)] = [st.st_size, st.st_mtime_ns]
+
+    walk(folder_path)
+    return files
+
+def archive_path(folder_path):
+    return os.path.join(os.path.dirname(folder_path), f"{os.path.basename(folder_path)}.7z")
+
+def archive_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def load_manifest(parent_folder):
+    try:
+        with open(os.path.join(parent_folder, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(parent_folder, manifest):
+    # 先寫暫存檔再取代，中斷時不會留下寫到一半的 manifest
+    path = os.path.join(parent_folder, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def choose_mode(folder_path, files, record):
+    """跟上次壓縮時的檔案清單比較，回傳 skip、update（7z u）或 create（重新壓縮）"""
+    output_path = archive_path(folder_path)
+    # 壓縮檔不見或被別人改過，就不能相信 manifest
+    if not record or not os.path.exists(output_path) or archive_stat(output_path) != record["archive"]:
+        return "create"
+    old_files = record["files"]
+    if old_files == files:
+        return "skip"
+    # 只有新增或修改的檔案可以用 7z u；有檔案被刪掉就整個重壓，避免壓縮檔裡留著舊檔
+    if old_files.keys() <= files.keys():
+        return "update"
+    return "create"
+
+def compress_folder(folder_path, threads=None, mode="create", files=None, summary=None):
+    # auto 模式在上層資料夾執行 7z，壓縮檔路徑要用絕對路徑
+    output_path = os.path.abspath(archive_path(folder_path))
+
+    # 使用 7z 命令進行壓縮，同時跑好幾個時輸出會混在一起，所以收起來只在失敗時印
+    # 重壓時先寫到暫存檔，成功才取代舊的壓縮檔
+    target = output_path if mode == "update" or not os.path.exists(output_path) else output_path + ".tmp.7z"
+    action = 'u' if mode == "update" else 'a'
+    extra = ['-bd']
+    if threads:
+        extra.append(f'-mmt{threads}')
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as list_dir:
+        if summary is not None and files:
+            # 在上層資料夾執行，listfile 裡的路徑從資料夾名稱開始，跟直接給資料夾時的結構一樣
+            parent_folder, folder_name = os.path.split(folder_path)
+            store, compress, store_bytes, compress_bytes = split_files(
+                parent_folder, [os.path.join(folder_name, name) for name in files])
+            method = choose_method(store_bytes, compress_bytes)
+            summary.add(folder_name, method, store, compress, store_bytes, compress_bytes)
+            commands = [profile_command(action, target, method, store + compress, list_dir, extra)]
+            cwd = parent_folder
+        else:
+            commands = [['7z', action, *extra, target, folder_path]]
+            cwd = None
+        for cmd in commands:
+            result = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True)
+            if result.returncode != 0:
+                if target != output_path and os.path.exists(target):
+                    os.remove(target)
+                raise RuntimeError(f"7z failed on {folder_path}:\n{result.stdout}{result.stderr}")
+    if target != output_path:
+        os.replace(target, output_path)
+    return output_path, time.perf_counter() - start
+
+def main(parent_folder, jobs=None, threads=None, force=False, profile="auto"):
+    manifest = load_manifest(parent_folder)
+    current = {}  # 這次還存在的資料夾，消失的資料夾會從 manifest 移除
+    folders = []
+    skipped = 0
     for folder_name in os.listdir(parent_folder):
         folder_path = os.path.join(parent_folder, folder_name)
-        if os.path.isdir(folder_path):
-            compress_folder(folder_path)
+        if not os.path.isdir(folder_path):
+            continue
+        files = scan_folder(folder_path)
+        record = manifest.get(folder_name)
+        mode = "create" if force else choose_mode(folder_path, files, record)
+        if mode == "skip":
+            current[folder_name] = record
+            skipped += 1
+            continue
+        size = sum(file_size for file_size, _ in files.values())
+        folders.append((size, folder_path, mode, files))
+    if skipped:
+        print(f"Skipping {skipped} unchanged folders")
+    if not folders:
+        save_manifest(parent_folder, current)
+        return
+
+    # 大的資料夾先送出，最後剩下的都是小工作，總時間比較短（LPT 排程）
+    folders.sort(key=lambda folder: folder[0], reverse=True)
+    threads = threads or os.cpu_count() or 1
+    jobs = max(1, min(jobs or max(1, threads // 2), len(folders)))
+    # 每個 7z 分到的執行緒，加起來不超過總預算
+    per_job = max(1, threads // jobs)
+    print(f"Compressing {len(folders)} folders with {jobs} jobs x {per_job} threads")
+
+    summary = ProfileSummary() if profile == "auto" else None
+    start = time.perf_counter()
+    total_size = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(compress_folder, folder_path, per_job, mode, files, summary): (size, folder_path, mode, files)
+                   for size, folder_path, mode, files in folders}
+        for future in as_completed(futures):
+            size, folder_path, mode, files = futures[future]
+            try:
+                output_path, seconds = future.result()
+            except RuntimeError as e:
+                print(e)
+                continue
+            # 每完成一個就寫回 manifest，中斷後重跑不會重做已經完成的資料夾
+            current[os.path.basename(folder_path)] = {"files": files, "archive": archive_stat(output_path)}
+            manifest.update(current)
+            save_manifest(parent_folder, manifest)
+            total_size += size
+            out_size = os.path.getsize(output_path)
+            throughput = size / 1e6 / seconds if seconds else 0
+            action = "Updated" if mode == "update" else "Compressed"
+            print(f"{action} {folder_path} to {output_path} "
+                  f"({size / 1e6:.1f} MB -> {out_size / 1e6:.1f} MB, {seconds:.1f}s, {throughput:.1f} MB/s)")
+    save_manifest(parent_folder, current)
+    elapsed = time.perf_counter() - start
+    if summary:
+        summary.report()
+    print(f"Total {total_size / 1e6:.1f} MB in {elapsed:.1f}s ({total_size / 1e6 / elapsed if elapsed else 0:.1f} MB/s)")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress every subfolder into its own .7z archive")
     # 替換成你的父資料夾路徑
-    parent_folder = "/Users/leo/gallery-dl/"
-    main(parent_folder)
+    parser.add_argument("parent_folder", nargs="?", default="/Users/leo/gallery-dl/", help="Folder whose subfolders are compressed")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of 7z processes at the same time (default: half the threads)")
+    parser.add_argument("-t", "--threads", type=int, help="Total thread budget split across the jobs with -mmt (default: CPU count)")
+    parser.add_argument("-f", "--force", action="store_true", help=f"Recompress every folder, ignoring {MANIFEST_NAME}")
+    parser.add_argument(
+        "-p", "--profile", choices=("auto", "default"), default="auto",
+        help="auto: store folders that are mostly already-compressed media with -mx0 and compress the others with LZMA2, "
+              "default: 7z's own settings")
+    args = parser.parse_args()
+    main(args.parent_folder, args.jobs, args.threads, args.force, args.profile)
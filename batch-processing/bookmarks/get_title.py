@@ -1,44 +1,416 @@
 # get url title to produce the bookmark html file
 
+import argparse
+import codecs
+import html
+import json
+import os
 import re
-import requests
-from bs4 import BeautifulSoup
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
 from urllib.parse import urlparse
 
-# 讀取 HTML 書籤文件
-with open('bookmarks.html', 'r', encoding='utf-8') as file:
-    soup = BeautifulSoup(file, 'lxml')
-
-# 找到所有的 <a> 標籤
-links = soup.find_all('a')
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 # 正則表達式，匹配 "of" 之後的第一個單詞
 artist_name_pattern = re.compile(r'of (\w+)')
+charset_pattern = re.compile(rb'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+HTML_TYPES = ("text/html", "application/xhtml+xml")
+CHUNK_SIZE = 16 * 1024
+# 標題通常在前幾 KB，讀到這裡還沒看到 </head> 就放棄
+MAX_HEAD_BYTES = 512 * 1024
+
+# 書籤檔的串流處理直接在位元組上做，位置可以精確記在 checkpoint 裡
+READ_SIZE = 1 << 20
+anchor_pattern = re.compile(rb'(<a\s[^>]*>)(.*?)(</a\s*>)', re.IGNORECASE | re.DOTALL)
+anchor_start_pattern = re.compile(rb'<a\s', re.IGNORECASE)
+href_pattern = re.compile(rb'\shref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
 
-# 遍歷所有的 <a> 標籤並更新標題
-for link in links:
-    url = link.get('href')
-    if url:
+class TitleParser(HTMLParser):
+    """逐塊餵入 HTML，看到 </title>、</head> 或 <body> 就設 done，不必下載整頁"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.in_title = False
+        self.parts = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self.in_title = True
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.done = True
+        elif tag == "head":
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.parts.append(data)
+
+    @property
+    def title(self):
+        return " ".join("".join(self.parts).split()) or None
+
+def response_charset(response, first_chunk):
+    # 沒有 charset 的 text/html，requests 會當成 ISO-8859-1，所以只信標頭明確寫的，其次找 <meta charset>
+    match = charset_pattern.search(response.headers.get("Content-Type", "").encode("latin-1", "ignore"))
+    match = match or charset_pattern.search(first_chunk)
+    if match:
         try:
+            return codecs.lookup(match.group(1).decode("ascii")).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+def extract_artist_name(title):
+    match = artist_name_pattern.search(title)
+    return match.group(1) if match else None
+
+class TitleCache:
+    """SQLite 紀錄 網址 -> 標題、artist name、ETag、Last-Modified
+
+    TTL 內的紀錄直接使用不連網路，過期的用 conditional GET 確認，大多只會拿到 304。
+    """
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS titles ("
+            "url TEXT PRIMARY KEY, title TEXT, artist TEXT, etag TEXT, last_modified TEXT, fetched_at REAL)"
+        )
+
+    def lookup(self, url):
+        return self.conn.execute(
+            "SELECT title, artist, etag, last_modified, fetched_at FROM titles WHERE url = ?", (url,)
+        ).fetchone()
+
+    def is_fresh(self, row):
+        return time.time() - row[4] < self.ttl
+
+    def record(self, url, title, etag, last_modified):
+        # 每筆都 commit，中斷後重跑不用重抓已經完成的網址
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, ?, ?)",
+                (url, title, extract_artist_name(title), etag, last_modified, time.time()),
+            )
+
+    def close(self):
+        self.conn.close()
+
+def interleave_by_host(urls):
+    # 依 host 輪流排列，同一個網站的網址不會擠在一起佔滿所有執行緒
+    queues = defaultdict(deque)
+    for url in urls:
+        queues[urlparse(url).netloc].append(url)
+    ordered = []
+    while queues:
+        for host in list(queues):
+            ordered.append(queues[host].popleft())
+            if not queues[host]:
+                del queues[host]
+    return ordered
+
+class TitleFetcher:
+    """共用一個 requests.Session 平行抓網頁標題
+
+    連線池大小跟執行緒數一樣，keep-alive 的連線會重複使用；每個 host 另外限制同時的請求數，
+    每個請求都有 timeout，不會卡住整批。stream 為 True 時只讀到 </title> 為止，非 HTML 的回應不讀內容。
+    有 cache 時先查快取，快取只在主執行緒讀寫。
+    """
+    def __init__(self, workers=16, per_host=4, timeout=10, stream=True, cache=None):
+        self.workers = workers
+        self.stream = stream
+        self.cache = cache
+        self.stats = Counter()
+        self.per_host = per_host
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.host_limits = {}
+
+    def host_limit(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_limits[host]
+
+    def fetch(self, url, cached=None):
+        """回傳 (標題, ETag, Last-Modified, 狀態)，cached 是快取的紀錄，有的話發 conditional GET"""
+        headers = {}
+        if cached:
+            _, _, etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        with self.host_limit(url):
             # 發送請求以獲取網頁內容
-            response = requests.get(url)
-            page_soup = BeautifulSoup(response.content, 'lxml')
-            title = page_soup.title.string.strip() if page_soup.title else urlparse(url).netloc
-
-            # 提取 artist name
-            match = artist_name_pattern.search(title)
-            if match:
-                artist_name = match.group(1)
-                link.string = artist_name
-                print(f"Updated: {url} with artist name: {artist_name}")
-            else:
-                print(f"No artist name found for: {url}")
+            with self.session.get(url, headers=headers, timeout=self.timeout, stream=self.stream) as response:
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                if response.status_code == 304 and cached:
+                    return cached[0], etag or cached[2], last_modified or cached[3], "not modified"
+                # 403、429、5xx 的錯誤頁標題不能進快取，當成失敗，下次再試
+                response.raise_for_status()
+                if self.stream:
+                    title = self.stream_title(response)
+                else:
+                    page_soup = BeautifulSoup(response.content, 'lxml')
+                    title = page_soup.title.string.strip() if page_soup.title and page_soup.title.string else None
+        return title or urlparse(url).netloc, etag, last_modified, "fetched"
 
+    def stream_title(self, response):
+        content_type = response.headers.get("Content-Type", "").lower()
+        if content_type and not content_type.startswith(HTML_TYPES):
+            return None
+        parser = TitleParser()
+        decoder = None
+        read = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(response_charset(response, chunk))(errors="replace")
+            parser.feed(decoder.decode(chunk))
+            read += len(chunk)
+            # 剩下的內容不讀，離開 with 時直接關掉連線
+            if parser.done or read >= MAX_HEAD_BYTES:
+                break
+        return parser.title
+
+    def submit(self, executor, url):
+        """TTL 內的快取直接回傳已完成的 future，其他交給 executor；只能在主執行緒呼叫"""
+        cached = self.cache.lookup(url) if self.cache else None
+        if cached and self.cache.is_fresh(cached):
+            future = Future()
+            future.set_result((cached[0], None, None, "cached"))
+            return future
+        return executor.submit(self.fetch, url, cached)
+
+    def result(self, url, future):
+        """取出 submit 的結果，回傳 (標題, 錯誤)，順便更新統計和快取"""
+        try:
+            title, etag, last_modified, status = future.result()
         except Exception as e:
-            print(f"Error fetching {url}: {e}")
+            self.stats["failed"] += 1
+            return None, e
+        self.stats[status] += 1
+        if self.cache and status != "cached":
+            self.cache.record(url, title, etag, last_modified)
+        return title, None
+
+    def fetch_all(self, urls):
+        """依完成順序產生 (網址, 標題, 錯誤)，重複的網址只抓一次，快取命中的最先出來"""
+        urls = interleave_by_host(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {self.submit(executor, url): url for url in urls}
+            for future in as_completed(futures):
+                url = futures[future]
+                yield url, *self.result(url, future)
+
+    def report(self, file=None):
+        print(", ".join(f"{count} {label}" for label, count in self.stats.items()), file=file)
+
+    def close(self):
+        self.session.close()
+
+def artist_for(url, title, error):
+    # 印出結果並回傳 artist name，找不到時回傳 None
+    if error is not None:
+        print(f"Error fetching {url}: {error}")
+        return None
+    # 提取 artist name
+    artist_name = extract_artist_name(title)
+    if artist_name:
+        print(f"Updated: {url} with artist name: {artist_name}")
+    else:
+        print(f"No artist name found for: {url}")
+    return artist_name
+
+def update_links(soup, fetcher):
+    # 找到所有的 <a> 標籤，同一個網址可能出現好幾次
+    links = defaultdict(list)
+    for link in soup.find_all('a'):
+        url = link.get('href')
+        if url:
+            links[url].append(link)
+
+    # 抓取在背景執行緒，改 soup 只在主執行緒做
+    for url, title, error in fetcher.fetch_all(links):
+        artist_name = artist_for(url, title, error)
+        if artist_name:
+            for link in links[url]:
+                link.string = artist_name
+    fetcher.report()
+
+def anchor_href(open_tag):
+    match = href_pattern.search(open_tag)
+    if not match:
+        return None
+    raw = next(group for group in match.groups() if group is not None)
+    return html.unescape(raw.decode("utf-8", "replace")) or None
+
+def iter_segments(file):
+    """SAX 式的單次掃描，不建立整棵樹
+
+    依序產生 (片段, 結束位置)；片段是原樣的位元組，或 <A> 元素的 (開始標籤, 內文, 結束標籤)。
+    結束位置是這個片段在輸入檔結束的位置，從 file 目前的位置開始算。
+    """
+    position = file.tell()  # buffer 開頭在輸入檔的位置
+    buffer = b""
+    while chunk := file.read(READ_SIZE):
+        buffer += chunk
+        pos = 0
+        for match in anchor_pattern.finditer(buffer):
+            if match.start() > pos:
+                yield buffer[pos:match.start()], position + match.start()
+            yield match.groups(), position + match.end()
+            pos = match.end()
+        # 還沒讀到 </A> 的 <A> 留到下一塊；結尾可能是剛好被切開的 "<A"
+        start = anchor_start_pattern.search(buffer, pos)
+        cut = start.start() if start else max(pos, len(buffer) - 2)
+        if cut > pos:
+            yield buffer[pos:cut], position + cut
+        position += cut
+        buffer = buffer[cut:]
+    if buffer:
+        yield buffer, position + len(buffer)
+
+class Checkpoint:
+    """記錄輸入檔處理到哪個位置、輸出檔寫了多少位元組，中斷後從這裡接著做"""
+    def __init__(self, path, input_path):
+        self.path = path
+        st = os.stat(input_path)
+        self.source = [os.path.abspath(input_path), st.st_size, st.st_mtime_ns]
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return 0, 0
+        # 輸入檔換過就從頭開始
+        if data.get("source") != self.source:
+            return 0, 0
+        return data["offset"], data["written"]
+
+    def save(self, offset, written):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"source": self.source, "offset": offset, "written": written}, f, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def rewrite_incremental(input_path, output_path, fetcher, checkpoint_every=100):
+    """不載入整個檔案，邊讀邊抓標題邊寫輸出，每處理 checkpoint_every 個 <A> 存一次 checkpoint
+
+    抓取在背景平行進行，但輸出依原本的順序寫；同時等待中的 <A> 數量有上限，記憶體用量固定。
+    """
+    checkpoint = Checkpoint(output_path + ".checkpoint", input_path)
+    offset, written = checkpoint.load()
+    if offset:
+        print(f"Resuming {input_path} from byte {offset}")
+    window = fetcher.workers * 4
+    pending = deque()  # (片段, 網址, 結束位置)，依輸入順序
+    in_flight = {}     # 網址 -> [future, 結果, 還在 pending 裡的數量]，視窗內重複的網址只抓一次
+    anchors = 0
+
+    with open(input_path, "rb") as src, open(output_path, "r+b" if written else "wb") as dst, \
+            ThreadPoolExecutor(max_workers=fetcher.workers) as executor:
+        src.seek(offset)
+        dst.seek(written)
+        dst.truncate()
+
+        def write_head():
+            nonlocal anchors
+            segment, url, end = pending.popleft()
+            if url is None:
+                dst.write(segment if isinstance(segment, bytes) else b"".join(segment))
+                return
+            entry = in_flight[url]
+            if entry[1] is None:
+                entry[1] = artist_for(url, *fetcher.result(url, entry[0])) or ""
+            entry[2] -= 1
+            if not entry[2]:
+                del in_flight[url]
+            open_tag, inner, close_tag = segment
+            if entry[1]:
+                inner = html.escape(entry[1], quote=False).encode("utf-8")
+            dst.write(open_tag + inner + close_tag)
+            anchors += 1
+            if anchors % checkpoint_every == 0:
+                dst.flush()
+                checkpoint.save(end, dst.tell())
+
+        for segment, end in iter_segments(src):
+            url = anchor_href(segment[0]) if isinstance(segment, tuple) else None
+            if url is not None:
+                if url not in in_flight:
+                    in_flight[url] = [fetcher.submit(executor, url), None, 0]
+                in_flight[url][2] += 1
+            pending.append((segment, url, end))
+            # 開頭的 <A> 還沒抓完就先等，讓輸出順序不變
+            while len(pending) > window or (pending and (pending[0][1] is None or in_flight[pending[0][1]][0].done())):
+                write_head()
+        while pending:
+            write_head()
+    checkpoint.remove()
+    fetcher.report()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replace bookmark names with the artist name found in each page title")
+    parser.add_argument("input", nargs="?", default="bookmarks.html", help="Bookmark file to read")
+    parser.add_argument("output", nargs="?", default="updated_bookmarks.html", help="Bookmark file to write")
+    parser.add_argument("-j", "--workers", type=int, default=16, help="Number of pages fetched at the same time")
+    parser.add_argument("--per-host", type=int, default=4, help="Maximum concurrent requests to the same host")
+    parser.add_argument("--timeout", type=float, default=10, help="Connect and read timeout in seconds")
+    parser.add_argument("--no-stream", action="store_true", help="Download and parse whole pages instead of stopping after </title>")
+    parser.add_argument("--cache", type=str, default="title_cache.sqlite", help="SQLite cache of fetched titles")
+    parser.add_argument("--cache-ttl", type=float, default=24 * 7, help="Hours before a cached title is revalidated with a conditional GET")
+    parser.add_argument("--no-cache", action="store_true", help="Fetch every URL without reading or writing the cache")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Rewrite the file in one streaming pass with checkpoints instead of loading it into BeautifulSoup; "
+             "an interrupted run resumes where it stopped")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else TitleCache(args.cache, args.cache_ttl * 3600)
+    fetcher = TitleFetcher(max(1, args.workers), max(1, args.per_host), args.timeout, not args.no_stream, cache)
+    try:
+        if args.incremental:
+            rewrite_incremental(args.input, args.output, fetcher)
+        else:
+            # 讀取 HTML 書籤文件
+            with open(args.input, 'r', encoding='utf-8') as file:
+                soup = BeautifulSoup(file, 'lxml')
+            update_links(soup, fetcher)
+            # 將更新的 HTML 寫回文件
+            with open(args.output, 'w', encoding='utf-8') as file:
+                file.write(str(soup))
+    finally:
+        fetcher.close()
+        if cache:
+            cache.close()
 
-# 將更新的 HTML 寫回文件
-with open('updated_bookmarks.html', 'w', encoding='utf-8') as file:
-    file.write(str(soup))
+    print("Bookmarks updated successfully.")
 
-print("Bookmarks updated successfully.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Convert urls.txt (or stdin) into a Netscape bookmark file, replaces urls2html.sh
+# Example: python urls2html.py urls.txt -o bookmarks.html
+import argparse
+import hashlib
+import html
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+
+try:
+    from get_title import TitleCache, TitleFetcher
+except ImportError:
+    TitleFetcher = None
+
+HEADER = """<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+"""
+FOOTER = "</DL><p>\n"
+DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+def normalize_url(url):
+    """去重用的比較鍵：scheme 和 host 小寫、去掉預設 port，空路徑當成 /"""
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if netloc.endswith(DEFAULT_PORTS.get(scheme, "\0")):
+        netloc = netloc[:-len(DEFAULT_PORTS[scheme])]
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+def unique_urls(lines, stats):
+    # 只存 16 bytes 的 BLAKE2 摘要，幾十萬行也只佔幾十 MB
+    seen = set()
+    for line in lines:
+        url = line.strip()
+        if not url or url.startswith("#"):
+            continue
+        key = hashlib.blake2b(normalize_url(url).encode("utf-8"), digest_size=16).digest()
+        if key in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(key)
+        stats["written"] += 1
+        yield url
+
+def entry(url, title=None):
+    return f'    <DT><A HREF="{html.escape(url)}">{html.escape(title or url, quote=False)}</A>\n'
+
+def write_bookmarks(urls, out, fetcher=None):
+    """邊讀邊寫，有 fetcher 時平行抓標題，但輸出維持輸入的順序，等待中的網址數量有上限"""
+    out.write(HEADER)
+    if fetcher is None:
+        for url in urls:
+            out.write(entry(url))
+    else:
+        window = fetcher.workers * 4
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=fetcher.workers) as executor:
+            def write_head():
+                url, future = pending.popleft()
+                title, error = fetcher.result(url, future)
+                if error is not None:
+                    print(f"Error fetching {url}: {error}", file=sys.stderr)
+                out.write(entry(url, title))
+
+            for url in urls:
+                pending.append((url, fetcher.submit(executor, url)))
+                while len(pending) > window or (pending and pending[0][1].done()):
+                    write_head()
+            while pending:
+                write_head()
+    out.write(FOOTER)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a list of URLs into a Netscape bookmark file that browsers can import")
+    parser.add_argument("input", nargs="?", default="urls.txt", help="File with one URL per line, - for stdin")
+    parser.add_argument("-o", "--output", type=str, help="Bookmark file to write (default: stdout)")
+    parser.add_argument("--titles", action="store_true", help="Use the page titles as bookmark names (needs the get_title.py requirements)")
+    parser.add_argument("-j", "--workers", type=int, default=16, help="Number of pages fetched at the same time")
+    parser.add_argument("--per-host", type=int, default=4, help="Maximum concurrent requests to the same host")
+    parser.add_argument("--timeout", type=float, default=10, help="Connect and read timeout in seconds")
+    parser.add_argument("--cache", type=str, default="title_cache.sqlite", help="SQLite cache of fetched titles")
+    parser.add_argument("--cache-ttl", type=float, default=24 * 7, help="Hours before a cached title is revalidated with a conditional GET")
+    parser.add_argument("--no-cache", action="store_true", help="Fetch every URL without reading or writing the cache")
+    args = parser.parse_args()
+    if args.titles and TitleFetcher is None:
+        parser.error("--titles requires beautifulsoup4, requests and lxml (see README.md)")
+
+    stats = {"duplicates": 0, "written": 0}
+    cache = fetcher = None
+    if args.titles:
+        cache = None if args.no_cache else TitleCache(args.cache, args.cache_ttl * 3600)
+        fetcher = TitleFetcher(max(1, args.workers), max(1, args.per_host), args.timeout, cache=cache)
+
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8", errors="replace")
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        write_bookmarks(unique_urls(src, stats), out, fetcher)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if out is not sys.stdout:
+            out.close()
+        if fetcher:
+            fetcher.close()
+            fetcher.report(file=sys.stderr)
+        if cache:
+            cache.close()
+    print(f"{stats['written']} bookmarks written, {stats['duplicates']} duplicates skipped", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,35 @@
 import argparse
+import csv
+import hashlib
+import io
+import json
 import os
 from pathlib import Path
+import shutil
+import sqlite3
 import subprocess
+import threading
 import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import chain, groupby
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
 
 class bcolors:
     HEADER = '\033[95m'  # 紫
@@ -15,127 +42,755 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-def convert_image(file_path, output_format, output_dir, quality, preserve_structure=False, input_base_dir=None, clean=False, force=False, sync_mtime=True):
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+MANIFEST_NAME = ".img2webp-manifest.sqlite"
+CONFLICT_POLICIES = ("skip", "overwrite", "newer", "rename")
+
+@dataclass
+class Variant:
+    """一個來源要輸出的其中一個檔案，worker 寫完後填入 out_size 和搜尋到的品質"""
+    output_format: str
+    output_file: Path
+    quality: int
+    max_size: int = None  # None 是原尺寸，其他是縮圖的長邊上限
+    chosen_quality: int = None
+    out_size: int = 0
+
+    @property
+    def label(self):
+        return self.output_format if self.max_size is None else f"{self.output_format}_{self.max_size}"
+
+def pyramid_levels(variants):
+    """依尺寸由大到小分組，原尺寸在最前面，下一層從上一層縮小"""
+    def level(variant):
+        return (variant.max_size is not None, -(variant.max_size or 0))
+    for _, group in groupby(sorted(variants, key=level), key=level):
+        group = list(group)
+        yield group[0].max_size, group
+
+@dataclass
+class ConvertResult:
+    file_path: Path
+    variants: list
+    digest: str = None
+    seconds: float = 0.0
+    pixels: int = 0
+
+    @property
+    def out_size(self):
+        return sum(variant.out_size for variant in self.variants)
+
+@dataclass
+class Summary:
+    input_count: int = 0
+    input_size: int = 0
+    output_count: int = 0
+    output_size: int = 0
+
+class Stats:
+    """--stats 用：收集每個檔案的轉換耗時，最後寫成 JSON/CSV 並印出百分位數和最慢的檔案"""
+    FIELDS = ("source", "output", "seconds", "bytes_in", "bytes_out", "pixels", "pixels_per_second")
+
+    def __init__(self, path, top=10):
+        self.path = Path(path)
+        self.top = top
+        self.rows = []
+
+    def add(self, result, st):
+        self.rows.append({
+            "source": str(result.file_path),
+            "output": ";".join(str(variant.output_file) for variant in result.variants),
+            "seconds": round(result.seconds, 6),
+            "bytes_in": st.st_size,
+            "bytes_out": result.out_size,
+            "pixels": result.pixels,
+            "pixels_per_second": round(result.pixels / result.seconds) if result.seconds > 0 else 0,
+        })
+
+    def write(self):
+        with open(self.path, "w", newline="", encoding="utf-8") as f:
+            if self.path.suffix.lower() == ".csv":
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.rows)
+            else:
+                json.dump(self.rows, f, ensure_ascii=False, indent=2)
+
+    def print_summary(self, elapsed):
+        if not self.rows:
+            return
+        seconds = sorted(row["seconds"] for row in self.rows)
+        busy = sum(seconds)
+        bytes_in = sum(row["bytes_in"] for row in self.rows)
+        pixels = sum(row["pixels"] for row in self.rows)
+
+        def percentile(p):
+            return seconds[min(len(seconds) - 1, int(p / 100 * len(seconds)))]
+
+        print(f"Elapsed\t\t\t: {elapsed:.2f} s ({len(self.rows) / elapsed:.1f} files/s)")
+        print(f"Encoder time\t\t: {busy:.2f} s ({bytes_in / (1024 * 1024) / busy if busy else 0:.2f} MB/s, {pixels / busy / 1e6 if busy else 0:.2f} MP/s)")
+        print(f"Per file p50/p90/p99\t: {percentile(50):.3f} / {percentile(90):.3f} / {percentile(99):.3f} s, max {seconds[-1]:.3f} s")
+        print(f"Slowest {self.top} files:")
+        for row in sorted(self.rows, key=lambda row: row["seconds"], reverse=True)[:self.top]:
+            print(f"  {row['seconds']:8.3f} s  {row['bytes_in'] / 1024:10.1f} KB  {row['source']}")
+        print(f"Stats written to\t: {self.path}")
+
+def image_pixels(file_path):
+    # Pillow 只讀檔頭，不會解碼整張圖；沒有 Pillow 就不計算
+    if Image is None:
+        return 0
+    try:
+        with Image.open(file_path) as img:
+            return img.width * img.height
+    except OSError:
+        return 0
+
+def file_digest(file_path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Manifest:
+    """輸出資料夾裡的 SQLite 紀錄，用 (來源, 輸出) 查詢，重跑時跳過沒變的檔案"""
+    def __init__(self, output_dir):
+        self.base_dir = output_dir.parent
+        self.conn = sqlite3.connect(output_dir / MANIFEST_NAME)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "source TEXT, output TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, quality INTEGER, "
+            "out_size INTEGER, PRIMARY KEY (source, output))"
+        )
+        # 自適應品質搜尋的結果，同樣內容的來源不用重新搜尋
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS qualities ("
+            "digest TEXT, format TEXT, target TEXT, quality INTEGER, "
+            "PRIMARY KEY (digest, format, target))"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        if "out_size" not in columns:
+            self.conn.execute("ALTER TABLE files ADD COLUMN out_size INTEGER")
+
+    def _key(self, file_path, output_file):
+        return os.path.relpath(file_path, self.base_dir), os.path.relpath(output_file, self.base_dir)
+
+    def lookup(self, file_path, output_file):
+        return self.conn.execute(
+            "SELECT size, mtime_ns, digest, quality, out_size FROM files WHERE source = ? AND output = ?",
+            self._key(file_path, output_file),
+        ).fetchone()
+
+    def is_current(self, row, file_path, output_file, st, quality):
+        size, mtime_ns, digest, recorded_quality, out_size = row
+        if recorded_quality != quality or size != st.st_size or out_size is None or not output_file.exists():
+            return False
+        if mtime_ns == st.st_mtime_ns:
+            return True
+        # 只有 mtime 變了（例如被 touch）才計算 hash 確認內容
+        if file_digest(file_path) != digest:
+            return False
+        self.record(file_path, output_file, st, digest, quality, out_size)
+        return True
+
+    def record(self, file_path, output_file, st, digest, quality, out_size):
+        # 每筆都 commit，中斷後重跑只需要重做還沒完成的檔案
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*self._key(file_path, output_file), st.st_size, st.st_mtime_ns, digest, quality, out_size),
+            )
+
+    def load_qualities(self, output_format, target):
+        rows = self.conn.execute(
+            "SELECT digest, quality FROM qualities WHERE format = ? AND target = ?",
+            (output_format, target),
+        )
+        return dict(rows)
+
+    def record_quality(self, digest, output_format, target, quality):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO qualities VALUES (?, ?, ?, ?)",
+                (digest, output_format, target, quality),
+            )
+
+    def close(self):
+        self.conn.close()
+
+class Deduplicator:
+    """先用檔案大小分桶，大小撞到才計算 BLAKE2，內容相同的來源只轉換一次"""
+    def __init__(self):
+        self.sizes = set()
+        self.unhashed = {}  # size -> (來源, {variant.label: 輸出})，同大小只有一個檔案時不用 hash
+        self.outputs = {}   # (size, digest) -> 第一個登記來源的 {variant.label: 輸出}
+
+    def match(self, file_path, st, outputs):
+        """登記檔案和它的 {variant.label: 輸出}，回傳 ({variant.label: 相同內容的既有輸出}, digest 或 None)"""
+        size = st.st_size
+        if size not in self.sizes:
+            self.sizes.add(size)
+            self.unhashed[size] = (file_path, outputs)
+            return {}, None
+        first = self.unhashed.pop(size, None)
+        if first is not None:
+            self.outputs.setdefault((size, file_digest(first[0])), first[1])
+        digest = file_digest(file_path)
+        canonical = self.outputs.setdefault((size, digest), outputs)
+        if canonical is outputs:
+            return {}, digest
+        # 第一個來源沒有的格式或尺寸就和它合併，之後的重複檔案也能連結
+        for key, output_file in outputs.items():
+            canonical.setdefault(key, output_file)
+        return {key: canonical[key] for key in outputs if canonical[key] != outputs[key]}, digest
+
+def link_duplicate(source_output, output_file):
+    # 優先用 hardlink，不支援的檔案系統才複製
+    output_file.unlink(missing_ok=True)
+    try:
+        os.link(source_output, output_file)
+    except OSError:
+        shutil.copy2(source_output, output_file)
+    return output_file.stat().st_size
+
+def get_output_file(file_path, output_format, output_dir, preserve_structure=False, input_base_dir=None, max_size=None):
+    name = file_path.stem if max_size is None else f"{file_path.stem}_{max_size}"
     if preserve_structure and input_base_dir:
         relative_path = file_path.relative_to(input_base_dir)
-        output_file = output_dir / relative_path.with_suffix(f".{output_format}")
+        output_file = output_dir / relative_path.with_name(f"{name}.{output_format}")
         output_file.parent.mkdir(parents=True, exist_ok=True)
     else:
-        output_file = output_dir / f"{file_path.stem}.{output_format}"
+        output_file = output_dir / f"{name}.{output_format}"
+    return output_file
 
-    if output_file.exists() and not force:
-        overwrite = input(f"File {output_file} already exists. Overwrite? (y/n/all): ").strip().lower()
-        if overwrite == 'n':
-            return False
-        elif overwrite == 'all':
-            force = True
-    
-    cmd = [
-        "magick", str(file_path),
-        "-quality", str(quality), "-type", "truecolor",
-        "-alpha", "on",
-        str(output_file)
-    ]
-    
+def encode_magick(file_path, variants, target=None):
+    # 一次解碼，用 -write 依序寫出每個格式和尺寸，最後輸出到 null:
+    # -resize 作用在目前的影像上，所以每一層縮圖都是從上一層縮小
+    cmd = ["magick", str(file_path), "-type", "truecolor", "-alpha", "on"]
+    for max_size, group in pyramid_levels(variants):
+        if max_size is not None:
+            cmd += ["-resize", f"{max_size}x{max_size}>"]
+        for variant in group:
+            cmd += ["-quality", str(variant.quality), "-write", str(variant.output_file)]
+    cmd.append("null:")
     subprocess.run(cmd, check=True)
+
+def load_pillow(file_path):
+    # 對齊 magick 的 -type truecolor -alpha on：一律轉成 RGBA，保留 EXIF 和 ICC
+    with Image.open(file_path) as img:
+        exif = img.info.get("exif")
+        icc_profile = img.info.get("icc_profile")
+        img = img.convert("RGBA")
+    options = {}
+    if exif:
+        options["exif"] = exif
+    if icc_profile:
+        options["icc_profile"] = icc_profile
+    return img, options
+
+def encode_pillow(file_path, variants, target=None):
+    # 只解碼一次，所有格式和尺寸都從同一份像素編碼，縮圖從上一層縮小
+    img, options = load_pillow(file_path)
+    for max_size, group in pyramid_levels(variants):
+        if max_size is not None:
+            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        rgb = None
+        for variant in group:
+            if variant.output_file.suffix.lower() in {".jpg", ".jpeg"}:
+                if rgb is None:
+                    rgb = img.convert("RGB")  # JPEG 沒有 alpha
+                source = rgb
+            else:
+                source = img
+            if target is None:
+                source.save(variant.output_file, quality=variant.quality, **options)
+            else:
+                variant.chosen_quality = save_adaptive(source, options, variant, target)
+
+BACKENDS = {
+    "magick": encode_magick,
+    "pillow": encode_pillow,
+}
+
+def ssim(a, b, window=8):
+    """平均 SSIM，用積分影像算 window x window 的區塊統計量，全部向量化"""
+    window = min(window, a.shape[0], a.shape[1])
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def box_mean(x):
+        c = np.pad(x.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+        return (c[window:, window:] - c[:-window, window:] - c[window:, :-window] + c[:-window, :-window]) / window**2
+
+    mu_a, mu_b = box_mean(a), box_mean(b)
+    var_a = box_mean(a * a) - mu_a**2
+    var_b = box_mean(b * b) - mu_b**2
+    cov = box_mean(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a**2 + mu_b**2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+def search_quality(img, encode, max_quality, target):
+    """二分搜尋品質：ssim 找達標的最低品質，bytes 找不超過大小的最高品質。回傳 (品質, 編碼結果)"""
+    mode, value = target
+    if mode == "ssim":
+        reference = np.asarray(img.convert("L"), dtype=np.float64)
+
+    def meets_target(data):
+        if mode == "bytes":
+            return len(data) <= value
+        with Image.open(io.BytesIO(data)) as decoded:
+            return ssim(reference, np.asarray(decoded.convert("L"), dtype=np.float64)) >= value
+
+    best = None
+    low, high = 1, max_quality
+    while low <= high:
+        mid = (low + high) // 2
+        data = encode(mid)
+        if meets_target(data):
+            best = (mid, data)
+            if mode == "ssim":
+                high = mid - 1
+            else:
+                low = mid + 1
+        elif mode == "ssim":
+            low = mid + 1
+        else:
+            high = mid - 1
+
+    if best is None:
+        # 最高品質也達不到 SSIM，或最低品質仍然太大，就用端點
+        quality = max_quality if mode == "ssim" else 1
+        best = (quality, encode(quality))
+    return best
+
+def save_adaptive(img, options, variant, target):
+    image_format = Image.registered_extensions()[variant.output_file.suffix.lower()]
+
+    def encode(quality):
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format, quality=quality, **options)
+        return buffer.getvalue()
+
+    # chosen_quality 有值代表 manifest 已經有搜尋過的結果
+    if variant.chosen_quality is not None:
+        quality, data = variant.chosen_quality, encode(variant.chosen_quality)
+    else:
+        quality, data = search_quality(img, encode, variant.quality, target)
+    variant.output_file.write_bytes(data)
+    return quality
+
+def target_key(quality, target):
+    # 寫進 manifest 的品質設定，固定品質維持整數
+    return quality if target is None else f"{target[0]}={target[1]}"
+
+def convert_image(file_path, variants, clean=False, sync_mtime=True, backend="magick", digest=False, target=None, quality_caches=None, timing=False):
+    result = ConvertResult(file_path, variants)
+    if digest:
+        result.digest = file_digest(file_path)
+    if timing:
+        result.pixels = image_pixels(file_path)
+    if target is not None and quality_caches is not None:
+        for variant in variants:
+            variant.chosen_quality = quality_caches[variant.label].get(result.digest)
+
+    start = time.perf_counter()
+    BACKENDS[backend](file_path, variants, target)
+    result.seconds = time.perf_counter() - start
+
+    # 每個檔案各自同步 mtime，完成順序不影響結果
+    # 用奈秒精度，--on-conflict newer 比較時才不會因為浮點誤差判斷錯
+    original_mtime = os.stat(file_path).st_mtime_ns
+    for variant in variants:
+        variant.out_size = variant.output_file.stat().st_size
+        if sync_mtime:
+            os.utime(variant.output_file, ns=(original_mtime, original_mtime))
+
     if clean:
         file_path.unlink()  # Clean the original file
-    
-    if sync_mtime:
-        original_mtime = os.path.getmtime(file_path)
-        os.utime(output_file, (original_mtime, original_mtime))
 
-    return force
+    return result
 
-def process_directory(directory, output_format, recursive, quality, output_dir, verbose, force, preserve_structure):
-    search_pattern = "**/*" if recursive else "*"
-    files = [file for file in directory.glob(search_pattern) if file.is_file()]
-    total_files = len(files) - 1
-    processed_files = 0
-    
-    for file_path in files:
-        if file_path.name.startswith('.'):
+def record_result(manifest, result, st, target, quality_caches):
+    for variant in result.variants:
+        setting = target_key(variant.quality, target)
+        manifest.record(result.file_path, variant.output_file, st, result.digest, setting, variant.out_size)
+        quality_cache = quality_caches[variant.label]
+        if variant.chosen_quality is not None and quality_cache.get(result.digest) != variant.chosen_quality:
+            quality_cache[result.digest] = variant.chosen_quality
+            manifest.record_quality(result.digest, variant.label, setting, variant.chosen_quality)
+
+def parse_formats(value, quality):
+    """解析 "avif:60,webp,jpg:85"，沒寫品質的格式用 --quality"""
+    formats = []
+    for item in value.split(","):
+        output_format, _, format_quality = item.strip().partition(":")
+        formats.append((output_format.lower(), int(format_quality) if format_quality else quality))
+    return formats
+
+def move_to_todo(file_path, directory, output_dir, preserve_structure):
+    if preserve_structure:
+        relative_path = file_path.relative_to(directory)
+        target_path = output_dir / 'todo' / relative_path
+    else:
+        target_path = output_dir / 'todo' / file_path.name
+
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if target_path.exists():
+        print(f"File {target_path} already exists. Skipping.")
+        return False
+    os.rename(file_path, target_path)
+    return True
+
+def iter_directory(directory, recursive):
+    """用 os.scandir 逐一產生 (Path, stat)，邊掃描邊轉換，記憶體只保留待走訪的資料夾"""
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                # 不跟隨資料夾的符號連結，連結指回上層時才不會一直走下去
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(entry.path)
+                elif entry.is_file():
+                    yield Path(entry.path), entry.stat()
+
+class DirectoryWatcher:
+    """監看資料夾，檔案 debounce 秒內沒有再變動才由 events() 產生 (Path, stat)
+
+    Observer 在 Linux 用 inotify、macOS 用 FSEvents。start() 要在掃描既有檔案之前呼叫，
+    掃描期間的事件會先累積在 changed，不會漏掉已經掃過的資料夾裡新寫入的檔案。
+    """
+    def __init__(self, directory, recursive, debounce=2.0):
+        self.directory = directory
+        self.watch_root = os.path.abspath(directory)
+        self.debounce = debounce
+        self.changed = {}  # 路徑 -> 最後一次事件的時間
+        self.lock = threading.Lock()
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory or event.event_type not in ("created", "modified", "moved", "closed"):
+                    return
+                path = event.dest_path if event.event_type == "moved" else event.src_path
+                with watcher.lock:
+                    watcher.changed[path] = time.monotonic()
+
+        self.observer = Observer()
+        self.observer.schedule(Handler(), self.watch_root, recursive=recursive)
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        if self.observer.is_alive():
+            self.observer.stop()
+            self.observer.join()
+
+    def events(self):
+        """沒有事件時每輪產生 None，讓 process_directory 可以收掉已經完成的結果。Ctrl-C 結束監看。"""
+        print(f"Watching {self.directory}, press Ctrl-C to stop.")
+        try:
+            while True:
+                time.sleep(min(self.debounce, 1.0) / 2)
+                now = time.monotonic()
+                with self.lock:
+                    ready = [path for path, last in self.changed.items() if now - last >= self.debounce]
+                    for path in ready:
+                        del self.changed[path]
+                for path in ready:
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue  # 例如下載中的暫存檔已經被改名
+                    if os.path.isfile(path):
+                        yield self.directory / os.path.relpath(path, self.watch_root), st
+                yield None
+        except KeyboardInterrupt:
+            print("\nStop watching.")
+        finally:
+            self.stop()
+
+def resolve_output(file_path, output_file, st, setting, on_conflict, manifest, claimed):
+    """不詢問使用者，直接決定輸出檔。回傳 (輸出檔, 是否轉換, 既有輸出大小, 是否屬於這個來源)
+
+    屬於這個來源的輸出是這次要轉換的，或 manifest 確認是這個來源之前寫的；
+    因為衝突策略跳過的既有檔案可能是別的同名來源的輸出，不能拿來連結重複檔案。
+
+    claimed 是正在轉換中的輸出，同名的來源不會同時寫同一個檔案，
+    除了 rename 以外一律跳過，這時輸出檔回傳 None。轉換完成後就會從 claimed 移除。
+    """
+    candidate = output_file
+    n = 0
+    while True:
+        in_use = candidate in claimed
+        row = manifest.lookup(file_path, candidate) if manifest and not in_use else None
+        if row is not None:
+            # manifest 認得的輸出是之前自己寫的，沒變就跳過，過期就直接覆寫
+            if manifest.is_current(row, file_path, candidate, st, setting):
+                return candidate, False, row[-1], True
+            return candidate, True, 0, True
+        if not in_use:
+            try:
+                output_stat = candidate.stat()
+            except FileNotFoundError:
+                return candidate, True, 0, True
+        if on_conflict == "rename":
+            n += 1
+            candidate = output_file.with_name(f"{output_file.stem} ({n}){output_file.suffix}")
             continue
-        elif file_path.suffix.lower() in {".jpg", "JPG", ".jpeg", ".png", ".PNG"}:
-            force = convert_image(file_path, output_format, output_dir, quality, preserve_structure, directory, clean=False, force=force, sync_mtime=True)
+        if in_use:
+            return None, False, 0, False
+        if on_conflict == "overwrite" or (on_conflict == "newer" and st.st_mtime_ns > output_stat.st_mtime_ns):
+            return candidate, True, 0, True
+        return candidate, False, output_stat.st_size, False
+
+def process_directory(directory, entries, formats, output_dir, verbose, on_conflict, preserve_structure, jobs=1, backend="magick", manifest=None, target=None, dedup=False, stats=None, clean=False, sizes=()):
+    """從 entries 串流取出檔案交給 worker，回傳 Summary"""
+    summary = Summary()
+    # 每個來源的輸出：每個格式的原尺寸加上每個縮圖尺寸
+    specs = [(output_format, quality, max_size) for output_format, quality in formats for max_size in (None, *sizes)]
+    quality_caches = {}
+    for output_format, quality, max_size in specs:
+        label = Variant(output_format, None, quality, max_size).label
+        quality_caches[label] = manifest.load_qualities(label, target_key(quality, target)) if manifest and target else {}
+    processed_files = 0
+    submitted_files = 0
+    skipped_files = 0
+    linked_files = 0
+    deduplicator = Deduplicator() if dedup else None
+    waiting = {}  # 轉換中的輸出 -> 等它完成後要連結的重複檔案
+    # 轉換或等待連結中的輸出 -> 來源，收掉結果時釋放，記憶體只跟排隊中的任務數量有關
+    claimed = {}
+    busy_sources = Counter()
+    # 最多同時排隊 jobs * 4 個任務，掃描不會跑在轉換前面太多
+    max_pending = jobs * 4
+    pending = {}
+
+    def claim(output_file, file_path):
+        claimed[output_file] = file_path
+        busy_sources[file_path] += 1
+
+    def release(output_file):
+        file_path = claimed.pop(output_file)
+        busy_sources[file_path] -= 1
+        if not busy_sources[file_path]:
+            del busy_sources[file_path]
+
+    def finish(result, st):
+        if manifest is not None:
+            record_result(manifest, result, st, target, quality_caches)
+        summary.output_count += len(result.variants)
+        summary.output_size += result.out_size
+        if verbose:
+            print(f"Successfully processed: {result.file_path.name}.")
+
+    def link(file_path, variant, st, digest, source_output):
+        nonlocal linked_files
+        variant.out_size = link_duplicate(source_output, variant.output_file)
+        finish(ConvertResult(file_path, [variant], digest), st)
+        linked_files += 1
+
+    def collect(timeout=None):
+        nonlocal processed_files
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            st = pending.pop(future)
+            result = future.result()
+            finish(result, st)
+            if stats is not None:
+                stats.add(result, st)
+            for variant in result.variants:
+                for duplicate in waiting.pop(variant.output_file, []):
+                    link(*duplicate, variant.output_file)
+                    release(duplicate[1].output_file)
+                release(variant.output_file)
             processed_files += 1
-            if verbose:
-                print(f"Successfully processed: {file_path.name}.")
-            print(f"Processing\t\t: {processed_files}/{total_files}", end="\r")
-        else:
-            if preserve_structure:
-                relative_path = file_path.relative_to(directory)
-                target_path = output_dir / 'todo' / relative_path
-            else:
-                target_path = output_dir / 'todo' / file_path.name
+            print(f"Processing\t\t: {processed_files}/{submitted_files}", end="\r")
 
-            target_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            if target_path.exists():
-                print(f"File {target_path} already exists. Skipping.")
+    # 非圖片檔案和覆寫確認都在主執行緒處理，只有轉換交給 worker
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for entry in entries:
+            # watch 模式沒有新檔案時會送 None，趁機收掉已經完成的結果
+            if entry is None:
+                if pending:
+                    collect(timeout=0)
                 continue
-            os.rename(file_path, target_path)
-    print()
+            file_path, st = entry
+            summary.input_count += 1
+            summary.input_size += st.st_size
+            if file_path.name.startswith('.'):
+                continue
+            elif file_path.suffix.lower() in IMAGE_SUFFIXES:
+                # watch 模式下同一個來源可能在上一次轉換還沒完成時又改了，等上一次完成再重新判斷
+                while busy_sources[file_path]:
+                    collect()
+                variants = []
+                outputs = {}
+                for output_format, quality, max_size in specs:
+                    output_file = get_output_file(file_path, output_format, output_dir, preserve_structure, directory, max_size)
+                    setting = target_key(quality, target)
+                    output_file, convert, existing_size, owned = resolve_output(file_path, output_file, st, setting, on_conflict, manifest, claimed)
+                    if output_file is None:
+                        skipped_files += 1
+                        if verbose:
+                            print(f"Output of {file_path} is already used by another file in this run. Skipping.")
+                        continue
+                    variant = Variant(output_format, output_file, quality, max_size)
+                    if owned:
+                        outputs[variant.label] = output_file
+                    if convert:
+                        variants.append(variant)
+                    else:
+                        skipped_files += 1
+                        summary.output_count += 1
+                        summary.output_size += existing_size
+
+                if deduplicator is not None and outputs:
+                    source_outputs, digest = deduplicator.match(file_path, st, outputs)
+                    remaining = []
+                    for variant in variants:
+                        source_output = source_outputs.get(variant.label)
+                        if source_output is None:
+                            remaining.append(variant)
+                        # 內容相同：等第一份轉換完成後直接連結，不再編碼
+                        elif source_output in waiting:
+                            waiting[source_output].append((file_path, variant, st, digest))
+                            claim(variant.output_file, file_path)
+                        else:
+                            link(file_path, variant, st, digest, source_output)
+                    variants = remaining
+                if not variants:
+                    continue
 
-def get_total_size_and_count(directory, recursive):
-    search_pattern = "**/*" if recursive else "*"
-    files = list(directory.glob(search_pattern))
-    total_size = sum(file_path.stat().st_size for file_path in files if file_path.is_file())
-    file_count = sum(1 for file_path in files if file_path.is_file())
-    return file_count, total_size
+                if len(pending) >= max_pending:
+                    collect()
+                future = executor.submit(
+                    convert_image, file_path, variants, clean, True, backend, manifest is not None, target, quality_caches, stats is not None
+                )
+                pending[future] = st
+                for variant in variants:
+                    waiting[variant.output_file] = []
+                    claim(variant.output_file, file_path)
+                submitted_files += 1
+            elif move_to_todo(file_path, directory, output_dir, preserve_structure):
+                summary.output_count += 1
+                summary.output_size += st.st_size
+        while pending:
+            collect()
+    print()
+    if skipped_files:
+        print(f"Skipped\t\t\t: {skipped_files}")
+    if linked_files:
+        print(f"Duplicates linked\t: {linked_files}")
+    return summary
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Convert images to a specified format",
+        description="Convert images to one or more formats",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument("input_path", type=str, help="Path to the input file or directory")
-    parser.add_argument("output_format", type=str, nargs="?", default="webp", help="Output format. Ex: avif/webp/jpg")
-    parser.add_argument("-q", "--quality", type=int, default=90, help="Quality of the output image")
+    parser.add_argument("output_format", type=str, nargs="?", default="webp", help="Output formats, comma separated with optional quality, all encoded from one decode. Ex: webp or avif:60,webp,jpg:85")
+    parser.add_argument("--sizes", type=str, default="", help="Also write thumbnails no larger than these sizes, each level resized from the previous one. Ex: 1024,512,256 -> name_1024.webp")
+    parser.add_argument("-q", "--quality", type=int, default=90, help="Quality of the output image, upper bound when searching for a target")
+    target_group = parser.add_mutually_exclusive_group()
+    target_group.add_argument("--target-ssim", type=float, help="Search the lowest quality per image whose SSIM reaches this value (needs pillow and numpy)")
+    target_group.add_argument("--target-bytes", type=int, help="Search the highest quality per image whose size fits in this many bytes (needs pillow)")
     parser.add_argument("-o", "--output_dir", type=str, default="out", help="Name of output directory, same level of input path")
     parser.add_argument("-c", "--clean", action='store_true', help="Clean original files")
     parser.add_argument("-r", "--recursive", action="store_true", help="Recursively search directories")
     parser.add_argument("--sync", action='store_false', help="Sync modify time for output file")
     parser.add_argument("--verbose", action="store_true", help="Magick processing verbose")
     parser.add_argument("--preserve-structure", action="store_true", help="Preserve the directory structure of the input files in the output directory")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="magick", help="Encoder backend, pillow runs in-process without spawning magick")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of magick processes running at the same time")
+    parser.add_argument("--on-conflict", choices=CONFLICT_POLICIES, default="skip", help="What to do when the output file already exists, newer overwrites only when the source is newer")
+    parser.add_argument("--dedup", action="store_true", help="Convert byte-identical images once and hardlink the other outputs")
+    parser.add_argument("--stats", type=str, help="Write per-file timing to this JSON or CSV file and print a timing summary")
+    parser.add_argument("--stats-top", type=int, default=10, help="Number of slowest files listed in the timing summary")
+    parser.add_argument("--watch", action="store_true", help="After converting the directory, keep watching it and convert new or modified files (needs watchdog)")
+    parser.add_argument("--debounce", type=float, default=2.0, help="Seconds a file must stay unchanged before --watch converts it")
+    parser.add_argument("--no-manifest", action="store_true", help=f"Do not read or write {MANIFEST_NAME} in the output directory")
 
     args = parser.parse_args()
 
     input_path = Path(args.input_path)
-    output_format = args.output_format
     recursive = args.recursive
-    quality = args.quality
+    formats = parse_formats(args.output_format, args.quality)
+    sizes = sorted({int(size) for size in args.sizes.split(",") if size.strip()}, reverse=True)
     clean = args.clean
     verbose = args.verbose
     preserve_structure = args.preserve_structure
+    jobs = max(1, args.jobs)
+    backend = args.backend
+    if backend == "pillow" and Image is None:
+        parser.error("--backend pillow requires Pillow (pip install pillow)")
+    target = None
+    if args.target_ssim is not None:
+        target = ("ssim", args.target_ssim)
+    elif args.target_bytes is not None:
+        target = ("bytes", args.target_bytes)
+    if target is not None and backend != "pillow":
+        parser.error("--target-ssim/--target-bytes require --backend pillow")
+    if args.target_ssim is not None and np is None:
+        parser.error("--target-ssim requires numpy (pip install numpy)")
+    if args.watch and Observer is None:
+        parser.error("--watch requires watchdog (pip install watchdog)")
+    if args.watch and not input_path.is_dir():
+        parser.error("--watch requires a directory input")
     output_dir = input_path.parent / args.output_dir
     output_dir.mkdir(parents=True, exist_ok=True)
-    force = False
+    manifest = None if args.no_manifest else Manifest(output_dir)
+    stats = Stats(args.stats, args.stats_top) if args.stats else None
+    watcher = None
+    start = time.perf_counter()
 
-    # 獲取原始資料夾的檔案數量和總容量
-    original_file_count, original_total_size = get_total_size_and_count(input_path, recursive)
-
-    if input_path.is_file():
-        force = convert_image(input_path, output_format, output_dir, quality, preserve_structure, input_path.parent, clean, force=force, sync_mtime=True)
-    elif input_path.is_dir():
-        process_directory(input_path, output_format, recursive, quality, output_dir, verbose, force, preserve_structure)
-    else:
-        print(f"Invalid input path: {input_path}")
-        parser.print_help()
-        return
-
-    # 獲取輸出資料夾的檔案數量和總容量
-    output_file_count, output_total_size = get_total_size_and_count(output_dir, recursive)
+    try:
+        if input_path.is_file():
+            entries = [(input_path, input_path.stat())]
+            summary = process_directory(
+                input_path.parent, entries, formats, output_dir, verbose, args.on_conflict, preserve_structure, 1, backend, manifest, target, False, stats, clean, sizes
+            )
+        elif input_path.is_dir():
+            # 掃描和轉換同時進行，原始統計直接用掃描時拿到的 stat
+            entries = iter_directory(input_path, recursive)
+            if args.watch:
+                # 先開始監看再掃描既有檔案（有 manifest 時很快），掃描期間的新檔案掃描完接著處理
+                watcher = DirectoryWatcher(input_path, recursive, args.debounce)
+                watcher.start()
+                entries = chain(entries, watcher.events())
+            try:
+                summary = process_directory(
+                    input_path, entries, formats, output_dir, verbose, args.on_conflict, preserve_structure, jobs, backend, manifest, target, args.dedup, stats, False, sizes
+                )
+            finally:
+                if watcher is not None:
+                    watcher.stop()
+        else:
+            print(f"Invalid input path: {input_path}")
+            parser.print_help()
+            return
+    finally:
+        if manifest is not None:
+            manifest.close()
 
     # 計算檔案縮小比例
-    size_reduction_ratio = (original_total_size - output_total_size) / original_total_size * 100 if original_total_size > 0 else 0
+    size_reduction_ratio = (summary.input_size - summary.output_size) / summary.input_size * 100 if summary.input_size > 0 else 0
 
     # 打印統計資訊
-    print(f"Original file count\t: {original_file_count}")
-    print(f"Output file count\t: {output_file_count}")
-    print(f"Original total size\t: {original_total_size / (1024 * 1024):.2f} MB")
-    print(f"Output total size\t: {output_total_size / (1024 * 1024):.2f} MB")
+    print(f"Original file count\t: {summary.input_count}")
+    print(f"Output file count\t: {summary.output_count}")
+    print(f"Original total size\t: {summary.input_size / (1024 * 1024):.2f} MB")
+    print(f"Output total size\t: {summary.output_size / (1024 * 1024):.2f} MB")
     print(f"Size reduction\t\t: {bcolors.OKGREEN}{size_reduction_ratio:.2f}%{bcolors.ENDC}")
 
+    if stats is not None:
+        stats.write()
+        stats.print_summary(time.perf_counter() - start)
+
 if __name__ == "__main__":
     main()
@@ -1,55 +1,340 @@
 # Move files to parent folder
+import argparse
+import errno
+import hashlib
+import json
 import os
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def move_files_to_parent_dir(parent_dir):
+STRATEGIES = ("skip", "suffix", "prefix", "hash")
+JOURNAL_NAME = ".move2parent-journal.jsonl"
+# 跨裝置複製主要在等 I/O，不用 -j 也預設平行
+COPY_WORKERS = 4
+
+def move_file(src_path, dest_path):
+    # 同一個檔案系統直接 rename，跨裝置（例如 bind mount）才退回 shutil.move
+    try:
+        os.rename(src_path, dest_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src_path, dest_path)
+
+def copy_data(src_fd, dest_fd, size):
+    """盡量用 zero-copy 在核心內複製，copy_file_range 不支援時退回 shutil（Linux 上是 sendfile）"""
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dest_fd, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError as e:
+            # 舊核心或不同種類的檔案系統之間不支援，還沒寫入任何資料時才能安全退回
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if sys.platform.startswith("linux"):
+        try:
+            while copied < size:
+                n = os.sendfile(dest_fd, src_fd, None, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError as e:
+            if copied or e.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+    with open(src_fd, "rb", closefd=False) as fsrc, open(dest_fd, "wb", closefd=False) as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+def copy_across(src_path, dest_path):
+    """跨裝置移動：先寫到暫存檔，確認大小一致並 fsync 之後才改名、刪除來源"""
+    tmp_path = dest_path + ".move2parent-part"
+    size = os.stat(src_path).st_size
+    with open(src_path, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+        copy_data(fsrc.fileno(), fdst.fileno(), size)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copystat(src_path, tmp_path)
+    copied = os.stat(tmp_path).st_size
+    if copied != size:
+        os.remove(tmp_path)
+        raise OSError(errno.EIO, f"Size mismatch after copy ({copied} != {size} bytes)", src_path)
+    os.rename(tmp_path, dest_path)
+    os.remove(src_path)
+
+def scan_tree(parent_dir):
+    """走訪一次所有子資料夾，回傳 (目標目錄的項目, 檔案清單, 資料夾清單)，資料夾清單裡子資料夾排在前面
+
+    每個資料夾都記下 st_dev，檔案清單會標出哪些檔案跟目標目錄不在同一個裝置上（例如 bind mount）。
+    """
+    parent_dev = os.stat(parent_dir).st_dev
+    files = []  # (來源路徑, 檔名, 所在資料夾名稱, 是否跨裝置)
+    dirs = []
+
+    def walk(directory, dev):
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    walk(entry.path, entry.stat(follow_symlinks=False).st_dev)
+                else:
+                    files.append((entry.path, entry.name, os.path.basename(directory), dev != parent_dev))
+        dirs.append(directory)
+
+    with os.scandir(parent_dir) as it:
+        top_entries = list(it)
+    for entry in top_entries:
+        if entry.is_dir(follow_symlinks=False):
+            walk(entry.path, entry.stat(follow_symlinks=False).st_dev)
+    return top_entries, files, dirs
+
+class ContentCache:
+    """比對兩個檔案內容，先比大小，大小相同才計算 BLAKE2，結果都會快取"""
+    def __init__(self):
+        self.sizes = {}
+        self.digests = {}
+
+    def size(self, path):
+        if path not in self.sizes:
+            self.sizes[path] = os.stat(path).st_size
+        return self.sizes[path]
+
+    def digest(self, path):
+        if path not in self.digests:
+            h = hashlib.blake2b(digest_size=16)
+            with open(path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    h.update(chunk)
+            self.digests[path] = h.hexdigest()
+        return self.digests[path]
+
+    def same(self, a, b):
+        return self.size(a) == self.size(b) and self.digest(a) == self.digest(b)
+
+def numbered(name, n):
+    stem, ext = os.path.splitext(name)
+    return f"{stem} ({n}){ext}"
+
+def plan_moves(parent_dir, strategy="suffix"):
+    """在移動任何檔案之前算好全部的動作，回傳 (動作清單, 資料夾清單)
+
+    動作是 ("move", 來源, 目的)、("copy", 來源, 目的)、("drop", 來源, 內容相同的檔案) 或 ("skip", 來源, 衝突的檔案)。
+    copy 是跨裝置的移動，rename 做不到，要複製後再刪除來源。
+    衝突只查記憶體裡的 holders（檔名 -> 目前佔用這個檔名的檔案），不會逐一 stat 目的地。
+    """
+    top_entries, files, dirs = scan_tree(parent_dir)
+    # 目標目錄下既有的名稱，包含子資料夾本身；子資料夾最後會被刪掉，但移動時還在
+    holders = {entry.name: entry.path for entry in top_entries}
+    content = ContentCache()
+    actions = []
+
+    for src_path, name, folder, cross_device in files:
+        dest_name = name
+        if strategy == "prefix" and name in holders:
+            dest_name = f"{folder}_{name}"
+
+        if dest_name in holders:
+            if strategy == "skip":
+                actions.append(("skip", src_path, os.path.join(parent_dir, dest_name)))
+                continue
+            n = 0
+            candidate = dest_name
+            duplicate_of = None
+            while candidate in holders:
+                holder = holders[candidate]
+                if strategy == "hash" and os.path.isfile(holder) and content.same(src_path, holder):
+                    duplicate_of = holder
+                    break
+                n += 1
+                candidate = numbered(dest_name, n)
+            if duplicate_of is not None:
+                actions.append(("drop", src_path, duplicate_of))
+                continue
+            dest_name = candidate
+
+        holders[dest_name] = src_path
+        actions.append(("copy" if cross_device else "move", src_path, os.path.join(parent_dir, dest_name)))
+    return actions, dirs
+
+class Journal:
+    """append-only 的 JSON lines：第一行是完整計畫，之後每完成一個動作寫一行索引
+
+    中斷後重跑直接從這裡讀計畫，不用重新掃描；全部完成後刪除。
+    """
+    def __init__(self, parent_dir):
+        self.path = os.path.join(parent_dir, JOURNAL_NAME)
+        self.file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def start(self, actions, dirs):
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.file.write(json.dumps({"actions": actions, "dirs": dirs}, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as f:
+            plan = json.loads(f.readline())
+            done = set()
+            for line in f:
+                try:
+                    done.add(json.loads(line)["done"])
+                except (ValueError, KeyError):
+                    break  # 中斷時寫到一半的最後一行
+        self.file = open(self.path, "a", encoding="utf-8")
+        return [tuple(action) for action in plan["actions"]], plan["dirs"], done
+
+    def mark(self, index):
+        self.file.write(json.dumps({"done": index}) + "\n")
+        self.file.flush()
+
+    def finish(self):
+        self.file.close()
+        os.remove(self.path)
+
+def run_action(action, src_path, dest_path):
+    # 來源不見但目的地已存在，代表上次中斷前已經做完，重跑時直接略過
+    if action in ("move", "copy"):
+        if not os.path.exists(src_path) and os.path.exists(dest_path):
+            return
+        if action == "copy":
+            copy_across(src_path, dest_path)
+        else:
+            move_file(src_path, dest_path)
+    elif action == "drop":
+        if os.path.exists(src_path):
+            os.remove(src_path)
+
+def print_plan(actions, dirs):
+    counts = {"move": 0, "copy": 0, "drop": 0, "skip": 0}
+    for action, src_path, dest_path in actions:
+        counts[action] += 1
+        if action == "move":
+            print(f"[dry-run] Move {src_path} to {dest_path}")
+        elif action == "copy":
+            print(f"[dry-run] Copy {src_path} to {dest_path} (cross-device), then remove the source")
+        elif action == "drop":
+            print(f"[dry-run] Remove {src_path}, same content as {dest_path}")
+        else:
+            print(f"[dry-run] Skip {src_path}, {dest_path} already exists")
+    print(f"{counts['move']} moves, {counts['copy']} cross-device copies, {counts['drop']} duplicates removed, {counts['skip']} skipped, {len(dirs)} folders checked")
+
+def execute_plan(actions, dirs, journal, done=(), workers=1, copy_workers=COPY_WORKERS):
+    # 檔案移動可以平行，適合延遲高的網路磁碟；journal 只在主執行緒寫
+    # 跨裝置的複製有自己的執行緒池，同裝置的 rename 很快，會在複製進行中陸續做完
+    moves = [(i, action) for i, action in enumerate(actions) if i not in done and action[0] in ("move", "copy")]
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=copy_workers) as copier:
+        futures = {
+            (copier if action[0] == "copy" else executor).submit(run_action, *action): (i, action)
+            for i, action in moves
+        }
+        for future in as_completed(futures):
+            future.result()
+            i, (action, src_path, dest_path) = futures[future]
+            journal.mark(i)
+            if action == "copy":
+                print(f"Copied {src_path} to {dest_path} across devices")
+            else:
+                print(f"Moving {src_path} to {dest_path}")
+
+    # 刪除重複檔案放在最後，前面的移動都還能 rollback
+    for i, (action, src_path, dest_path) in enumerate(actions):
+        if i in done:
+            continue
+        if action == "drop":
+            print(f"Removing {src_path}, same content as {dest_path}")
+            run_action(action, src_path, dest_path)
+            journal.mark(i)
+        elif action == "skip":
+            print(f"File {dest_path} already exists, skipping {src_path}")
+
+    # 刪除空的子資料夾，子資料夾排在前面，一次就能由下往上刪乾淨
+    for directory in dirs:
+        try:
+            os.rmdir(directory)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+            continue
+        print(f"Removing empty directory {directory}")
+    journal.finish()
+
+def rollback(journal):
+    actions, _, done = journal.load()
+    # 不只看 journal 的紀錄，來源不在、目的地存在的移動都還原，涵蓋寫 journal 前就中斷的情況
+    for i in reversed(range(len(actions))):
+        action, src_path, dest_path = actions[i]
+        if action in ("move", "copy") and not os.path.exists(src_path) and os.path.exists(dest_path):
+            os.makedirs(os.path.dirname(src_path), exist_ok=True)
+            print(f"Moving {dest_path} back to {src_path}")
+            move_file(dest_path, src_path)
+        elif action == "drop" and i in done:
+            print(f"Cannot restore {src_path}, it was a duplicate of {dest_path}")
+    journal.finish()
+
+def move_files_to_parent_dir(parent_dir, strategy="suffix", dry_run=False, plan_file=None, workers=1, copy_workers=COPY_WORKERS):
     # 檢查目標目錄是否存在
     if not os.path.isdir(parent_dir):
         print(f"The directory {parent_dir} does not exist.")
         return
 
-    # 遍歷目標目錄下的所有子資料夾
-    for root, dirs, files in os.walk(parent_dir):
-        # 排除目標目錄本身
-        if root == parent_dir:
-            continue
-        
-        # 移動檔案到目標目錄
-        for file in files:
-            src_path = os.path.join(root, file)
-            dest_path = os.path.join(parent_dir, file)
-            
-            # 防止覆蓋已有的同名檔案
-            if os.path.exists(dest_path):
-                print(f"File {dest_path} already exists, skipping {src_path}")
-                continue
-            
-            print(f"Moving {src_path} to {dest_path}")
-            shutil.move(src_path, dest_path)
-        
-        # 刪除空的子資料夾
-        for dir in dirs:
-            dir_path = os.path.join(root, dir)
-            if not os.listdir(dir_path):
-                print(f"Removing empty directory {dir_path}")
-                os.rmdir(dir_path)
-
-    # 最後再一次檢查，刪除所有可能已經變成空的資料夾
-    for root, dirs, files in os.walk(parent_dir):
-        for dir in dirs:
-            dir_path = os.path.join(root, dir)
-            if not os.listdir(dir_path):
-                print(f"Removing empty directory {dir_path}")
-                os.rmdir(dir_path)
+    # journal 裡記的是絕對路徑，換個工作目錄再繼續或 rollback 也找得到檔案
+    parent_dir = os.path.abspath(parent_dir)
+    journal = Journal(parent_dir)
+    resumed = journal.exists()
+    if resumed:
+        print(f"Resuming the interrupted run from {journal.path}")
+        actions, dirs, done = journal.load()
+    else:
+        actions, dirs = plan_moves(parent_dir, strategy)
+        done = set()
+
+    if plan_file:
+        with open(plan_file, "w", encoding="utf-8") as f:
+            json.dump({"actions": actions, "dirs": dirs}, f, ensure_ascii=False, indent=2)
+        print(f"Plan written to {plan_file}")
+    if dry_run:
+        print_plan([action for i, action in enumerate(actions) if i not in done], dirs)
+        return
+
+    if not resumed:
+        journal.start(actions, dirs)
+    execute_plan(actions, dirs, journal, done, workers, copy_workers)
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: ./move.py /path/to/dir")
+    parser = argparse.ArgumentParser(
+        description="Move files in all subfolders to the parent folder and remove the emptied subfolders",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("parent_dir", type=str, help="Path to the parent folder")
+    parser.add_argument(
+        "-s", "--strategy", choices=STRATEGIES, default="suffix",
+        help="Name collision handling: skip leaves the file in place, suffix renames to 'name (1).ext', "
+             "prefix renames to 'folder_name.ext', hash drops identical files and renames different ones",
+    )
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Only print the planned moves")
+    parser.add_argument("--plan", type=str, help="Also export the planned moves to this JSON file")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Number of renames running at the same time, useful on network drives")
+    parser.add_argument("--copy-workers", type=int, default=COPY_WORKERS, help="Number of cross-device copies running at the same time")
+    parser.add_argument("--rollback", action="store_true", help=f"Undo the moves of an interrupted run recorded in {JOURNAL_NAME}")
+    args = parser.parse_args()
+
+    if args.rollback:
+        journal = Journal(os.path.abspath(args.parent_dir))
+        if not journal.exists():
+            print(f"No journal found in {args.parent_dir}")
+            return
+        rollback(journal)
         return
-    
-    parent_dir = sys.argv[1]
-    move_files_to_parent_dir(parent_dir)
+    move_files_to_parent_dir(args.parent_dir, args.strategy, args.dry_run, args.plan, max(1, args.workers), max(1, args.copy_workers))
 
 if __name__ == "__main__":
     main()